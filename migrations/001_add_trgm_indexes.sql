@@ -0,0 +1,32 @@
+-- Триграммные GIN-индексы для поиска ILIKE '%...%'.
+-- Без них каждый search_* инструмент делает последовательное сканирование
+-- таблицы; с pg_trgm планировщик использует индекс для ILIKE автоматически,
+-- без изменения запросов.
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+-- Закупки
+CREATE INDEX IF NOT EXISTS ix_pp_nom_trgm
+    ON purchase_prices USING gin (nomenclature_name gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS ix_pp_ctr_trgm
+    ON purchase_prices USING gin (contractor_name gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS ix_pp_doc_date
+    ON purchase_prices (doc_date DESC);
+
+-- Продажи
+CREATE INDEX IF NOT EXISTS ix_sales_nom_trgm
+    ON sales USING gin (nomenclature_name gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS ix_sales_client_trgm
+    ON sales USING gin (client_name gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS ix_sales_doc_date
+    ON sales (doc_date DESC);
+
+-- Справочники
+CREATE INDEX IF NOT EXISTS ix_nom_name_trgm
+    ON nomenclature USING gin (name gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS ix_nom_article_trgm
+    ON nomenclature USING gin (article gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS ix_clients_name_trgm
+    ON clients USING gin (name gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS ix_clients_inn_trgm
+    ON clients USING gin (inn gin_trgm_ops);
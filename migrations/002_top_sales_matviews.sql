@@ -0,0 +1,37 @@
+-- Подневные агрегаты продаж для топ-N инструментов.
+-- get_top_clients / get_top_products читают эти вьюхи вместо полного
+-- прохода по sales: стоимость запроса пропорциональна числу групп,
+-- а не числу строк реализаций.
+--
+-- Обновление (например, ночью по cron):
+--   REFRESH MATERIALIZED VIEW CONCURRENTLY mv_sales_by_client_day;
+--   REFRESH MATERIALIZED VIEW CONCURRENTLY mv_sales_by_product_day;
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS mv_sales_by_client_day AS
+SELECT date_trunc('day', doc_date)::date AS d,
+       client_name,
+       SUM(sum_with_vat) AS s,
+       COUNT(DISTINCT doc_number) AS o
+FROM sales
+WHERE doc_type = 'Реализация'
+GROUP BY 1, 2;
+
+-- Уникальный индекс нужен для REFRESH CONCURRENTLY
+CREATE UNIQUE INDEX IF NOT EXISTS ux_mv_sales_client_day
+    ON mv_sales_by_client_day (client_name, d);
+CREATE INDEX IF NOT EXISTS ix_mv_sales_client_day_d
+    ON mv_sales_by_client_day (d);
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS mv_sales_by_product_day AS
+SELECT date_trunc('day', doc_date)::date AS d,
+       nomenclature_name,
+       SUM(quantity) AS q,
+       SUM(sum_with_vat) AS s
+FROM sales
+WHERE doc_type = 'Реализация'
+GROUP BY 1, 2;
+
+CREATE UNIQUE INDEX IF NOT EXISTS ux_mv_sales_product_day
+    ON mv_sales_by_product_day (nomenclature_name, d);
+CREATE INDEX IF NOT EXISTS ix_mv_sales_product_day_d
+    ON mv_sales_by_product_day (d);
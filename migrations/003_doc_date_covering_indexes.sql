@@ -0,0 +1,29 @@
+-- Покрывающие индексы под "последние N документов".
+-- search_purchases/search_sales всегда делают ORDER BY doc_date DESC LIMIT N:
+-- btree по doc_date DESC c INCLUDE всех возвращаемых колонок превращает
+-- сортировку всей выборки в index-only проход по диапазону, и латентность
+-- перестаёт зависеть от размера таблицы. Заменяют простые индексы
+-- ix_pp_doc_date / ix_sales_doc_date из миграции 001.
+
+DROP INDEX IF EXISTS ix_pp_doc_date;
+CREATE INDEX IF NOT EXISTS ix_pp_doc_date_covering
+    ON purchase_prices (doc_date DESC)
+    INCLUDE (doc_number, contractor_name, nomenclature_name,
+             quantity, price, sum_total);
+
+DROP INDEX IF EXISTS ix_sales_doc_date;
+CREATE INDEX IF NOT EXISTS ix_sales_doc_date_covering
+    ON sales (doc_date DESC)
+    INCLUDE (doc_type, doc_number, client_name, nomenclature_name,
+             quantity, price, sum_with_vat);
+
+-- BRIN для чисто диапазонных аналитических запросов по дате: почти бесплатен
+-- для append-only таблиц документов.
+CREATE INDEX IF NOT EXISTS ix_pp_date_brin
+    ON purchase_prices USING brin (doc_date) WITH (pages_per_range = 32);
+CREATE INDEX IF NOT EXISTS ix_sales_date_brin
+    ON sales USING brin (doc_date) WITH (pages_per_range = 32);
+
+-- Проверка, что планировщик использует индекс:
+--   EXPLAIN (ANALYZE, BUFFERS)
+--   SELECT * FROM sales ORDER BY doc_date DESC LIMIT 20;
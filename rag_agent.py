@@ -9,11 +9,14 @@
 """
 
 import streamlit as st
-import psycopg2
-import pandas as pd
-from datetime import datetime, timedelta
+from datetime import datetime, date, timedelta
 import anthropic
+import asyncio
+import asyncpg
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import json
+import orjson
 import re
 import requests
 from urllib.parse import quote_plus
@@ -34,85 +37,240 @@ st.set_page_config(
 # ============================================================
 
 @st.cache_resource
-def get_db_connection():
-    return psycopg2.connect(
+def get_event_loop():
+    """Фоновый event loop для asyncpg (живёт всё время работы приложения)"""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+
+def run_async(coro):
+    """Выполняет корутину в фоновом event loop и возвращает результат"""
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop()).result()
+
+
+@st.cache_resource
+def get_db_pool():
+    return run_async(asyncpg.create_pool(
         host=st.secrets["postgres"]["host"],
         port=st.secrets["postgres"]["port"],
         database=st.secrets["postgres"]["database"],
         user=st.secrets["postgres"]["user"],
         password=st.secrets["postgres"]["password"],
-    )
+        min_size=4,
+        max_size=16,
+        statement_cache_size=256,
+    ))
 
 
-def execute_query(query: str, params: tuple = None) -> pd.DataFrame:
-    """Выполняет SQL-запрос и возвращает DataFrame"""
-    try:
-        conn = get_db_connection()
-        df = pd.read_sql(query, conn, params=params)
-        return df
-    except Exception as e:
-        st.error(f"Ошибка БД: {e}")
-        return pd.DataFrame()
+# Кэш текстов SQL по форме запроса (набору активных фильтров). Одинаковый текст
+# для одной формы позволяет asyncpg переиспользовать server-side prepared
+# statement соединения вместо повторного parse/plan на каждый вызов.
+_SQL_CACHE = {}
 
 
-# ============================================================
-# ФУНКЦИИ ПОИСКА ПО ДАННЫМ
-# ============================================================
+async def _fetch(pool, sql: str, params: list = None) -> list:
+    """Выполняет запрос через пул и возвращает список dict-строк"""
+    rows = await pool.fetch(sql, *(params or []))
+    return [dict(r) for r in rows]
 
-def search_purchases(query: str = None, supplier: str = None, 
-                     date_from: str = None, date_to: str = None,
-                     limit: int = 20) -> dict:
-    """Поиск по закупкам"""
-    conditions = ["1=1"]
+
+async def _gather(*coros):
+    """Выполняет несколько корутин параллельно.
+
+    asyncio.gather нельзя вызывать из потока Streamlit напрямую: там нет
+    работающего event loop, а run_async принимает только корутину —
+    поэтому gather заворачивается в корутину и запускается в фоновом loop.
+    """
+    return await asyncio.gather(*coros)
+
+
+# Реестры фильтров поисковых функций: (имя аргумента, SQL-фрагмент,
+# извлечение параметров). Собираются один раз при импорте; WHERE строится
+# одним join по активным фильтрам, {N} заменяется на номерные placeholder'ы.
+# Один параметр может использоваться во фрагменте несколько раз ({0} дважды),
+# поэтому шаблон %query% аллоцируется и передаётся на сервер один раз.
+NOMENCLATURE_FILTERS = (
+    ("query", "(n.name ILIKE {0} OR n.article ILIKE {0})",
+     lambda v: [f"%{v}%"]),
+)
+
+CLIENT_FILTERS = (
+    ("query", "(name ILIKE {0} OR inn ILIKE {0})",
+     lambda v: [f"%{v}%"]),
+)
+
+MEMORY_FILTERS = (
+    ("query", "(fact ILIKE {0} OR subject ILIKE {0})",
+     lambda v: [f"%{v}%"]),
+    ("category", "category = {0}", lambda v: [v]),
+)
+
+
+def _build_where(filters, args: dict, base: str = "1=1") -> tuple:
+    """Собирает условия WHERE и список параметров по реестру фильтров"""
+    conditions = [base]
     params = []
-    
-    if query:
-        conditions.append("(nomenclature_name ILIKE %s OR contractor_name ILIKE %s)")
-        params.extend([f"%{query}%", f"%{query}%"])
-    
-    if supplier:
-        conditions.append("contractor_name ILIKE %s")
-        params.append(f"%{supplier}%")
-    
-    if date_from:
-        conditions.append("doc_date >= %s")
-        params.append(date_from)
-    
-    if date_to:
-        conditions.append("doc_date <= %s")
-        params.append(date_to)
-    
-    sql = f"""
+    for name, frag, extract in filters:
+        value = args.get(name)
+        if not value:
+            continue
+        placeholders = []
+        for p in extract(value):
+            params.append(p)
+            placeholders.append(f"${len(params)}")
+        conditions.append(frag.format(*placeholders))
+    return conditions, params
+
+
+PURCHASE_STAT_KEYS = ("total_records", "suppliers", "products",
+                      "total_sum", "min_date", "max_date")
+SALES_STAT_KEYS = ("total_records", "clients", "sales_sum", "corrections_sum")
+
+
+# У закупок и продаж текст запроса константный: все фильтры присутствуют
+# всегда и отключаются NULL-параметрами. Одна форма запроса вместо 2^N —
+# один план и один server-side prepared statement на соединение.
+PURCHASES_SQL = """
+    WITH filtered AS (
         SELECT doc_date, doc_number, contractor_name, nomenclature_name,
                quantity, price, sum_total
         FROM purchase_prices
-        WHERE {' AND '.join(conditions)}
-        ORDER BY doc_date DESC
-        LIMIT {limit}
-    """
-    
-    df = execute_query(sql, tuple(params) if params else None)
-    
-    # Статистика
-    stats_sql = f"""
-        SELECT 
+        WHERE ($1::text IS NULL OR nomenclature_name ILIKE $1 OR contractor_name ILIKE $1)
+          AND ($2::text IS NULL OR contractor_name ILIKE $2)
+          AND ($3::date IS NULL OR doc_date >= $3)
+          AND ($4::date IS NULL OR doc_date <= $4)
+    ),
+    stats AS (
+        SELECT
             COUNT(*) as total_records,
             COUNT(DISTINCT contractor_name) as suppliers,
             COUNT(DISTINCT nomenclature_name) as products,
             COALESCE(SUM(sum_total), 0) as total_sum,
             MIN(doc_date) as min_date,
             MAX(doc_date) as max_date
-        FROM purchase_prices
-        WHERE {' AND '.join(conditions)}
+        FROM filtered
+    ),
+    page AS (
+        SELECT * FROM filtered
+        ORDER BY doc_date DESC
+        LIMIT $5
+    )
+    SELECT page.*, stats.*
+    FROM stats LEFT JOIN page ON TRUE
+    ORDER BY page.doc_date DESC NULLS LAST
+"""
+
+SALES_SQL = """
+    WITH filtered AS (
+        SELECT doc_type, doc_date, doc_number, client_name,
+               nomenclature_name, quantity, price, sum_with_vat
+        FROM sales
+        WHERE ($1::text IS NULL OR nomenclature_name ILIKE $1 OR client_name ILIKE $1)
+          AND ($2::text IS NULL OR client_name ILIKE $2)
+          AND ($3::text IS NULL OR doc_type = $3)
+          AND ($4::date IS NULL OR doc_date >= $4)
+          AND ($5::date IS NULL OR doc_date <= $5)
+    ),
+    stats AS (
+        SELECT
+            COUNT(*) as total_records,
+            COUNT(DISTINCT client_name) as clients,
+            COALESCE(SUM(CASE WHEN doc_type = 'Реализация' THEN sum_with_vat ELSE 0 END), 0) as sales_sum,
+            COALESCE(SUM(CASE WHEN doc_type = 'Корректировка' THEN sum_with_vat ELSE 0 END), 0) as corrections_sum
+        FROM filtered
+    ),
+    page AS (
+        SELECT * FROM filtered
+        ORDER BY doc_date DESC
+        LIMIT $6
+    )
+    SELECT page.*, stats.*
+    FROM stats LEFT JOIN page ON TRUE
+    ORDER BY page.doc_date DESC NULLS LAST
+"""
+
+
+def _tabular(rows: list) -> dict:
+    """Преобразует строки-словари в колоночный вид.
+
+    Имена колонок передаются один раз вместо повторения в каждой строке —
+    результат компактнее и в JSON, и в токенах промпта LLM.
     """
-    stats_df = execute_query(stats_sql, tuple(params) if params else None)
-    stats = stats_df.iloc[0].to_dict() if not stats_df.empty else {}
-    
+    if not rows:
+        return {"columns": [], "rows": []}
+    columns = list(rows[0].keys())
+    return {
+        "columns": columns,
+        "rows": [[row.get(col) for col in columns] for row in rows]
+    }
+
+
+def _split_page_stats(rows: list, stat_keys: tuple) -> tuple:
+    """Разделяет строки комбинированного запроса на данные и статистику.
+
+    Статистические колонки продублированы в каждой строке; при пустой
+    выборке приходит одна строка с NULL вместо колонок данных.
+    """
+    if not rows:
+        return [], {}
+    stats = {k: rows[0][k] for k in stat_keys}
+    data = [
+        {k: v for k, v in row.items() if k not in stat_keys}
+        for row in rows
+        if row["doc_date"] is not None
+    ]
+    return data, stats
+
+
+# ============================================================
+# ФУНКЦИИ ПОИСКА ПО ДАННЫМ
+# ============================================================
+
+def search_purchases(query: str = None, supplier: str = None, 
+                     date_from: str = None, date_to: str = None,
+                     limit: int = 20) -> dict:
+    """Поиск по закупкам"""
+    params = [
+        f"%{query}%" if query else None,
+        f"%{supplier}%" if supplier else None,
+        date.fromisoformat(date_from) if date_from else None,
+        date.fromisoformat(date_to) if date_to else None,
+        limit,
+    ]
+
+    rows = run_async(_fetch(get_db_pool(), PURCHASES_SQL, params))
+    data, stats = _split_page_stats(rows, PURCHASE_STAT_KEYS)
+
     return {
         "type": "purchases",
-        "data": df.to_dict('records') if not df.empty else [],
-        "stats": stats,
-        "query_used": sql
+        "data": _tabular(data),
+        "stats": stats
+    }
+
+
+def search_purchases_batch(queries: list, limit_per_term: int = 10) -> dict:
+    """Поиск по закупкам по нескольким терминам одним запросом"""
+    sql = """
+        SELECT q.term, pp.doc_date, pp.doc_number, pp.contractor_name,
+               pp.nomenclature_name, pp.quantity, pp.price, pp.sum_total
+        FROM unnest($1::text[]) AS q(term)
+        JOIN LATERAL (
+            SELECT doc_date, doc_number, contractor_name, nomenclature_name,
+                   quantity, price, sum_total
+            FROM purchase_prices
+            WHERE nomenclature_name ILIKE '%' || q.term || '%'
+               OR contractor_name ILIKE '%' || q.term || '%'
+            ORDER BY doc_date DESC
+            LIMIT $2
+        ) pp ON TRUE
+    """
+    rows = run_async(_fetch(get_db_pool(), sql, [list(queries), limit_per_term]))
+
+    return {
+        "type": "purchases_batch",
+        "terms": list(queries),
+        "data": _tabular(rows)
     }
 
 
@@ -120,238 +278,219 @@ def search_sales(query: str = None, client: str = None,
                  doc_type: str = None, date_from: str = None, 
                  date_to: str = None, limit: int = 20) -> dict:
     """Поиск по продажам"""
-    conditions = ["1=1"]
-    params = []
-    
-    if query:
-        conditions.append("(nomenclature_name ILIKE %s OR client_name ILIKE %s)")
-        params.extend([f"%{query}%", f"%{query}%"])
-    
-    if client:
-        conditions.append("client_name ILIKE %s")
-        params.append(f"%{client}%")
-    
-    if doc_type:
-        conditions.append("doc_type = %s")
-        params.append(doc_type)
-    
-    if date_from:
-        conditions.append("doc_date >= %s")
-        params.append(date_from)
-    
-    if date_to:
-        conditions.append("doc_date <= %s")
-        params.append(date_to)
-    
-    sql = f"""
-        SELECT doc_type, doc_date, doc_number, client_name, 
-               nomenclature_name, quantity, price, sum_with_vat
-        FROM sales
-        WHERE {' AND '.join(conditions)}
-        ORDER BY doc_date DESC
-        LIMIT {limit}
-    """
-    
-    df = execute_query(sql, tuple(params) if params else None)
-    
-    stats_sql = f"""
-        SELECT 
-            COUNT(*) as total_records,
-            COUNT(DISTINCT client_name) as clients,
-            COALESCE(SUM(CASE WHEN doc_type = 'Реализация' THEN sum_with_vat ELSE 0 END), 0) as sales_sum,
-            COALESCE(SUM(CASE WHEN doc_type = 'Корректировка' THEN sum_with_vat ELSE 0 END), 0) as corrections_sum
-        FROM sales
-        WHERE {' AND '.join(conditions)}
-    """
-    stats_df = execute_query(stats_sql, tuple(params) if params else None)
-    stats = stats_df.iloc[0].to_dict() if not stats_df.empty else {}
-    
+    params = [
+        f"%{query}%" if query else None,
+        f"%{client}%" if client else None,
+        doc_type if doc_type else None,
+        date.fromisoformat(date_from) if date_from else None,
+        date.fromisoformat(date_to) if date_to else None,
+        limit,
+    ]
+
+    rows = run_async(_fetch(get_db_pool(), SALES_SQL, params))
+    data, stats = _split_page_stats(rows, SALES_STAT_KEYS)
+
     return {
         "type": "sales",
-        "data": df.to_dict('records') if not df.empty else [],
+        "data": _tabular(data),
         "stats": stats
     }
 
 
 def search_nomenclature(query: str = None, limit: int = 30) -> dict:
     """Поиск по номенклатуре"""
-    conditions = ["n.is_folder = false"]
-    params = []
-    
-    if query:
-        conditions.append("(n.name ILIKE %s OR n.article ILIKE %s)")
-        params.extend([f"%{query}%", f"%{query}%"])
-    
-    sql = f"""
-        SELECT n.name, n.article, n.code, nt.name as type_name
-        FROM nomenclature n
-        LEFT JOIN nomenclature_types nt ON n.type_id = nt.id
-        WHERE {' AND '.join(conditions)}
-        ORDER BY n.name
-        LIMIT {limit}
-    """
-    
-    df = execute_query(sql, tuple(params) if params else None)
-    
+    conditions, params = _build_where(NOMENCLATURE_FILTERS, {"query": query},
+                                      base="n.is_folder = false")
+    params.append(limit)
+    shape = ("nomenclature", bool(query))
+
+    if shape in _SQL_CACHE:
+        sql = _SQL_CACHE[shape]
+    else:
+        sql = f"""
+            SELECT n.name, n.article, n.code, nt.name as type_name
+            FROM nomenclature n
+            LEFT JOIN nomenclature_types nt ON n.type_id = nt.id
+            WHERE {' AND '.join(conditions)}
+            ORDER BY n.name
+            LIMIT ${len(params)}
+        """
+        _SQL_CACHE[shape] = sql
+
+    rows = run_async(_fetch(get_db_pool(), sql, params))
+
     return {
         "type": "nomenclature",
-        "data": df.to_dict('records') if not df.empty else [],
-        "total_found": len(df)
+        "data": _tabular(rows),
+        "total_found": len(rows)
     }
 
 
 def search_clients(query: str = None, limit: int = 30) -> dict:
     """Поиск по клиентам"""
-    conditions = ["1=1"]
-    params = []
-    
-    if query:
-        conditions.append("(name ILIKE %s OR inn ILIKE %s)")
-        params.extend([f"%{query}%", f"%{query}%"])
-    
-    sql = f"""
-        SELECT name, inn
-        FROM clients
-        WHERE {' AND '.join(conditions)}
-        ORDER BY name
-        LIMIT {limit}
-    """
-    
-    df = execute_query(sql, tuple(params) if params else None)
-    
+    conditions, params = _build_where(CLIENT_FILTERS, {"query": query})
+    params.append(limit)
+    shape = ("clients", bool(query))
+
+    if shape in _SQL_CACHE:
+        sql = _SQL_CACHE[shape]
+    else:
+        sql = f"""
+            SELECT name, inn
+            FROM clients
+            WHERE {' AND '.join(conditions)}
+            ORDER BY name
+            LIMIT ${len(params)}
+        """
+        _SQL_CACHE[shape] = sql
+
+    rows = run_async(_fetch(get_db_pool(), sql, params))
+
     return {
         "type": "clients",
-        "data": df.to_dict('records') if not df.empty else [],
-        "total_found": len(df)
+        "data": _tabular(rows),
+        "total_found": len(rows)
     }
 
 
-def get_price_dynamics(nomenclature: str) -> dict:
+def get_price_dynamics(nomenclature: str, detail_limit: int = 100) -> dict:
     """Динамика цен на номенклатуру"""
-    sql = """
+    # Агрегаты считаются на стороне Postgres и приходят одной строкой;
+    # по сети едут только последние detail_limit записей истории
+    stats_sql = """
+        SELECT MIN(price) as min_price,
+               MAX(price) as max_price,
+               AVG(price) as avg_price,
+               (array_agg(price ORDER BY doc_date))[1] as first_price,
+               (array_agg(price ORDER BY doc_date DESC))[1] as last_price,
+               round((((array_agg(price ORDER BY doc_date DESC))[1]
+                       - (array_agg(price ORDER BY doc_date))[1])
+                      / NULLIF((array_agg(price ORDER BY doc_date))[1], 0)
+                      * 100)::numeric, 1) as price_change_pct
+        FROM purchase_prices
+        WHERE nomenclature_name ILIKE $1
+    """
+    detail_sql = """
         SELECT doc_date, contractor_name, price, quantity
         FROM purchase_prices
-        WHERE nomenclature_name ILIKE %s
-        ORDER BY doc_date
+        WHERE nomenclature_name ILIKE $1
+        ORDER BY doc_date DESC
+        LIMIT $2
     """
-    df = execute_query(sql, (f"%{nomenclature}%",))
-    
-    if df.empty:
+
+    pool = get_db_pool()
+    like = f"%{nomenclature}%"
+    stats_row, rows = run_async(_gather(
+        pool.fetchrow(stats_sql, like),
+        _fetch(pool, detail_sql, [like, detail_limit]),
+    ))
+
+    if not rows or stats_row["min_price"] is None:
         return {"type": "price_dynamics", "data": [], "message": "Данные не найдены"}
-    
-    stats = {
-        "min_price": float(df['price'].min()),
-        "max_price": float(df['price'].max()),
-        "avg_price": float(df['price'].mean()),
-        "first_price": float(df.iloc[0]['price']),
-        "last_price": float(df.iloc[-1]['price']),
-        "price_change_pct": round((df.iloc[-1]['price'] - df.iloc[0]['price']) / df.iloc[0]['price'] * 100, 1)
-    }
-    
+
+    # Детали приходят от новых к старым — разворачиваем в хронологию
+    rows.reverse()
+
+    stats = {k: (float(v) if v is not None else None)
+             for k, v in dict(stats_row).items()}
+
     return {
         "type": "price_dynamics",
         "nomenclature": nomenclature,
-        "data": df.to_dict('records'),
+        "data": _tabular(rows),
         "stats": stats
     }
 
 
 def get_top_clients(date_from: str = None, date_to: str = None, limit: int = 10) -> dict:
     """Топ клиентов по продажам"""
-    conditions = ["doc_type = 'Реализация'"]
-    params = []
-    
-    if date_from:
-        conditions.append("doc_date >= %s")
-        params.append(date_from)
-    if date_to:
-        conditions.append("doc_date <= %s")
-        params.append(date_to)
-    
-    sql = f"""
-        SELECT client_name, 
-               SUM(sum_with_vat) as total_sum,
-               COUNT(DISTINCT doc_number) as orders_count
-        FROM sales
-        WHERE {' AND '.join(conditions)}
+    # Читаем подневный агрегат (migrations/002) вместо полного прохода по sales
+    sql = """
+        SELECT client_name,
+               SUM(s) as total_sum,
+               SUM(o) as orders_count
+        FROM mv_sales_by_client_day
+        WHERE ($1::date IS NULL OR d >= $1)
+          AND ($2::date IS NULL OR d <= $2)
         GROUP BY client_name
         ORDER BY total_sum DESC
-        LIMIT {limit}
+        LIMIT $3
     """
-    
-    df = execute_query(sql, tuple(params) if params else None)
-    
+    params = [date.fromisoformat(date_from) if date_from else None,
+              date.fromisoformat(date_to) if date_to else None,
+              limit]
+
+    rows = run_async(_fetch(get_db_pool(), sql, params))
+
     return {
         "type": "top_clients",
-        "data": df.to_dict('records') if not df.empty else []
+        "data": _tabular(rows)
     }
 
 
 def get_top_products(date_from: str = None, date_to: str = None, limit: int = 10) -> dict:
     """Топ продуктов по продажам"""
-    conditions = ["doc_type = 'Реализация'"]
-    params = []
-    
-    if date_from:
-        conditions.append("doc_date >= %s")
-        params.append(date_from)
-    if date_to:
-        conditions.append("doc_date <= %s")
-        params.append(date_to)
-    
-    sql = f"""
+    sql = """
         SELECT nomenclature_name,
-               SUM(quantity) as total_qty,
-               SUM(sum_with_vat) as total_sum
-        FROM sales
-        WHERE {' AND '.join(conditions)}
+               SUM(q) as total_qty,
+               SUM(s) as total_sum
+        FROM mv_sales_by_product_day
+        WHERE ($1::date IS NULL OR d >= $1)
+          AND ($2::date IS NULL OR d <= $2)
         GROUP BY nomenclature_name
         ORDER BY total_sum DESC
-        LIMIT {limit}
+        LIMIT $3
     """
-    
-    df = execute_query(sql, tuple(params) if params else None)
-    
+    params = [date.fromisoformat(date_from) if date_from else None,
+              date.fromisoformat(date_to) if date_to else None,
+              limit]
+
+    rows = run_async(_fetch(get_db_pool(), sql, params))
+
     return {
         "type": "top_products",
-        "data": df.to_dict('records') if not df.empty else []
+        "data": _tabular(rows)
     }
 
 
 def get_summary_stats() -> dict:
     """Общая статистика по базе"""
-    purchases = execute_query("""
-        SELECT COUNT(*) as cnt, COALESCE(SUM(sum_total), 0) as total,
-               MIN(doc_date) as min_date, MAX(doc_date) as max_date
-        FROM purchase_prices
-    """)
-    
-    sales = execute_query("""
-        SELECT COUNT(*) as cnt, 
-               COALESCE(SUM(CASE WHEN doc_type='Реализация' THEN sum_with_vat ELSE 0 END), 0) as sales_total,
-               COALESCE(SUM(CASE WHEN doc_type='Корректировка' THEN sum_with_vat ELSE 0 END), 0) as corr_total,
-               MIN(doc_date) as min_date, MAX(doc_date) as max_date
-        FROM sales
-    """)
-    
-    nom_count = execute_query("SELECT COUNT(*) as cnt FROM nomenclature WHERE is_folder = false")
-    clients_count = execute_query("SELECT COUNT(*) as cnt FROM clients")
-    
+    pool = get_db_pool()
+
+    # Четыре независимых запроса выполняются параллельно:
+    # общее время равно самому медленному из них, а не их сумме
+    purchases, sales, nom_count, clients_count = run_async(_gather(
+        pool.fetchrow("""
+            SELECT COUNT(*) as cnt, COALESCE(SUM(sum_total), 0) as total,
+                   MIN(doc_date) as min_date, MAX(doc_date) as max_date
+            FROM purchase_prices
+        """),
+        pool.fetchrow("""
+            SELECT COUNT(*) as cnt,
+                   COALESCE(SUM(CASE WHEN doc_type='Реализация' THEN sum_with_vat ELSE 0 END), 0) as sales_total,
+                   COALESCE(SUM(CASE WHEN doc_type='Корректировка' THEN sum_with_vat ELSE 0 END), 0) as corr_total,
+                   MIN(doc_date) as min_date, MAX(doc_date) as max_date
+            FROM sales
+        """),
+        pool.fetchrow("SELECT COUNT(*) as cnt FROM nomenclature WHERE is_folder = false"),
+        pool.fetchrow("SELECT COUNT(*) as cnt FROM clients"),
+    ))
+
     return {
         "type": "summary",
         "purchases": {
-            "records": int(purchases.iloc[0]['cnt']),
-            "total_sum": float(purchases.iloc[0]['total']),
-            "period": f"{purchases.iloc[0]['min_date']} — {purchases.iloc[0]['max_date']}"
+            "records": int(purchases['cnt']),
+            "total_sum": float(purchases['total']),
+            "period": f"{purchases['min_date']} — {purchases['max_date']}"
         },
         "sales": {
-            "records": int(sales.iloc[0]['cnt']),
-            "sales_sum": float(sales.iloc[0]['sales_total']),
-            "corrections_sum": float(sales.iloc[0]['corr_total']),
-            "period": f"{sales.iloc[0]['min_date']} — {sales.iloc[0]['max_date']}"
+            "records": int(sales['cnt']),
+            "sales_sum": float(sales['sales_total']),
+            "corrections_sum": float(sales['corr_total']),
+            "period": f"{sales['min_date']} — {sales['max_date']}"
         },
-        "nomenclature_count": int(nom_count.iloc[0]['cnt']),
-        "clients_count": int(clients_count.iloc[0]['cnt'])
+        "nomenclature_count": int(nom_count['cnt']),
+        "clients_count": int(clients_count['cnt'])
     }
 
 
@@ -458,11 +597,10 @@ def web_search(query: str, max_results: int = 5) -> dict:
 def init_memory_tables():
     """Создаёт таблицы памяти если их нет"""
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
+        pool = get_db_pool()
+
         # История чатов
-        cur.execute("""
+        run_async(pool.execute("""
             CREATE TABLE IF NOT EXISTS chat_history (
                 id SERIAL PRIMARY KEY,
                 session_id VARCHAR(100),
@@ -472,16 +610,16 @@ def init_memory_tables():
                 tools_used JSONB,
                 created_at TIMESTAMP DEFAULT NOW()
             )
-        """)
-        
+        """))
+
         # Индекс для полнотекстового поиска
-        cur.execute("""
-            CREATE INDEX IF NOT EXISTS idx_chat_history_content_gin 
+        run_async(pool.execute("""
+            CREATE INDEX IF NOT EXISTS idx_chat_history_content_gin
             ON chat_history USING gin(to_tsvector('russian', content))
-        """)
-        
+        """))
+
         # Память агента
-        cur.execute("""
+        run_async(pool.execute("""
             CREATE TABLE IF NOT EXISTS agent_memory (
                 id SERIAL PRIMARY KEY,
                 category VARCHAR(100),
@@ -494,10 +632,8 @@ def init_memory_tables():
                 updated_at TIMESTAMP DEFAULT NOW(),
                 is_active BOOLEAN DEFAULT TRUE
             )
-        """)
-        
-        conn.commit()
-        cur.close()
+        """))
+
         return True
     except Exception as e:
         st.error(f"Ошибка создания таблиц памяти: {e}")
@@ -507,14 +643,11 @@ def init_memory_tables():
 def save_message_to_history(session_id: str, role: str, content: str, tools_used: list = None):
     """Сохраняет сообщение в историю"""
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("""
+        run_async(get_db_pool().execute("""
             INSERT INTO chat_history (session_id, role, content, tools_used)
-            VALUES (%s, %s, %s, %s)
-        """, (session_id, role, content, json.dumps(tools_used) if tools_used else None))
-        conn.commit()
-        cur.close()
+            VALUES ($1, $2, $3, $4)
+        """, session_id, role, content,
+            _dumps(tools_used) if tools_used else None))
     except Exception as e:
         pass  # Не прерываем работу если не удалось сохранить
 
@@ -522,35 +655,35 @@ def save_message_to_history(session_id: str, role: str, content: str, tools_used
 def search_chat_history(query: str, limit: int = 10) -> dict:
     """Поиск по истории чатов"""
     try:
-        conn = get_db_connection()
-        
+        pool = get_db_pool()
+
         # Полнотекстовый поиск по русски
         sql = """
             SELECT role, content, created_at,
-                   ts_rank(to_tsvector('russian', content), plainto_tsquery('russian', %s)) as rank
+                   ts_rank(to_tsvector('russian', content), plainto_tsquery('russian', $1)) as rank
             FROM chat_history
-            WHERE to_tsvector('russian', content) @@ plainto_tsquery('russian', %s)
+            WHERE to_tsvector('russian', content) @@ plainto_tsquery('russian', $1)
             ORDER BY rank DESC, created_at DESC
-            LIMIT %s
+            LIMIT $2
         """
-        df = pd.read_sql(sql, conn, params=(query, query, limit))
-        
-        if df.empty:
+        rows = run_async(_fetch(pool, sql, [query, limit]))
+
+        if not rows:
             # Пробуем простой ILIKE если полнотекстовый не дал результатов
             sql_simple = """
                 SELECT role, content, created_at
                 FROM chat_history
-                WHERE content ILIKE %s
+                WHERE content ILIKE $1
                 ORDER BY created_at DESC
-                LIMIT %s
+                LIMIT $2
             """
-            df = pd.read_sql(sql_simple, conn, params=(f"%{query}%", limit))
-        
+            rows = run_async(_fetch(pool, sql_simple, [f"%{query}%", limit]))
+
         return {
             "type": "chat_history",
             "query": query,
-            "results": df.to_dict('records') if not df.empty else [],
-            "total_found": len(df)
+            "results": rows,
+            "total_found": len(rows)
         }
     except Exception as e:
         return {
@@ -564,35 +697,26 @@ def search_chat_history(query: str, limit: int = 10) -> dict:
 def search_agent_memory(query: str = None, category: str = None, limit: int = 20) -> dict:
     """Поиск по памяти агента"""
     try:
-        conn = get_db_connection()
-        
-        conditions = ["is_active = true"]
-        params = []
-        
-        if query:
-            conditions.append("(fact ILIKE %s OR subject ILIKE %s)")
-            params.extend([f"%{query}%", f"%{query}%"])
-        
-        if category:
-            conditions.append("category = %s")
-            params.append(category)
-        
+        conditions, params = _build_where(MEMORY_FILTERS,
+                                          {"query": query, "category": category},
+                                          base="is_active = true")
+        params.append(limit)
         sql = f"""
             SELECT category, subject, fact, source, confidence, created_at
             FROM agent_memory
             WHERE {' AND '.join(conditions)}
             ORDER BY confidence DESC, created_at DESC
-            LIMIT {limit}
+            LIMIT ${len(params)}
         """
-        
-        df = pd.read_sql(sql, conn, params=tuple(params) if params else None)
-        
+
+        rows = run_async(_fetch(get_db_pool(), sql, params))
+
         return {
             "type": "agent_memory",
             "query": query,
             "category": category,
-            "results": df.to_dict('records') if not df.empty else [],
-            "total_found": len(df)
+            "results": rows,
+            "total_found": len(rows)
         }
     except Exception as e:
         return {
@@ -605,37 +729,31 @@ def search_agent_memory(query: str = None, category: str = None, limit: int = 20
 def save_to_memory(category: str, subject: str, fact: str, source: str = "chat") -> dict:
     """Сохраняет факт в память агента"""
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
+        pool = get_db_pool()
+
         # Проверяем нет ли похожего факта
-        cur.execute("""
-            SELECT id FROM agent_memory 
-            WHERE subject ILIKE %s AND fact ILIKE %s AND is_active = true
+        existing = run_async(pool.fetchrow("""
+            SELECT id FROM agent_memory
+            WHERE subject ILIKE $1 AND fact ILIKE $2 AND is_active = true
             LIMIT 1
-        """, (f"%{subject}%", f"%{fact[:100]}%"))
-        
-        existing = cur.fetchone()
-        
+        """, f"%{subject}%", f"%{fact[:100]}%"))
+
         if existing:
             # Обновляем существующий
-            cur.execute("""
-                UPDATE agent_memory 
+            run_async(pool.execute("""
+                UPDATE agent_memory
                 SET updated_at = NOW(), confidence = LEAST(confidence + 0.1, 1.0)
-                WHERE id = %s
-            """, (existing[0],))
+                WHERE id = $1
+            """, existing["id"]))
             action = "updated"
         else:
             # Создаём новый
-            cur.execute("""
+            run_async(pool.execute("""
                 INSERT INTO agent_memory (category, subject, fact, source)
-                VALUES (%s, %s, %s, %s)
-            """, (category, subject, fact, source))
+                VALUES ($1, $2, $3, $4)
+            """, category, subject, fact, source))
             action = "created"
-        
-        conn.commit()
-        cur.close()
-        
+
         return {
             "type": "save_memory",
             "status": "success",
@@ -654,18 +772,17 @@ def save_to_memory(category: str, subject: str, fact: str, source: str = "chat")
 def get_recent_context(limit: int = 5) -> dict:
     """Получает последние сообщения для контекста"""
     try:
-        conn = get_db_connection()
         sql = """
             SELECT role, content, created_at
             FROM chat_history
             ORDER BY created_at DESC
-            LIMIT %s
+            LIMIT $1
         """
-        df = pd.read_sql(sql, conn, params=(limit,))
-        
+        rows = run_async(_fetch(get_db_pool(), sql, [limit]))
+
         return {
             "type": "recent_context",
-            "messages": df.to_dict('records') if not df.empty else []
+            "messages": rows
         }
     except Exception as e:
         return {"type": "recent_context", "messages": [], "error": str(e)}
@@ -739,6 +856,18 @@ TOOLS = [
             }
         }
     },
+    {
+        "name": "search_purchases_batch",
+        "description": "Поиск по закупкам сразу по нескольким товарам или поставщикам одним запросом. Используй вместо серии вызовов search_purchases, когда в вопросе несколько позиций ('сахар, мука, масло').",
+        "input_schema": {
+            "type": "object",
+            "properties": {
+                "queries": {"type": "array", "items": {"type": "string"}, "description": "Список поисковых терминов"},
+                "limit_per_term": {"type": "integer", "description": "Максимум записей на термин", "default": 10}
+            },
+            "required": ["queries"]
+        }
+    },
     {
         "name": "search_sales",
         "description": "Поиск по продажам (реализации и корректировки). Используй для вопросов о продажах, клиентах, выручке.",
@@ -822,39 +951,109 @@ TOOLS = [
 ]
 
 
-def execute_tool(tool_name: str, tool_input: dict) -> str:
-    """Выполняет инструмент и возвращает результат"""
+def _dumps(obj) -> str:
+    """Сериализует результат инструмента в JSON (orjson заметно быстрее
+    stdlib на кириллице; даты и Decimal уходят через default=str)"""
+    return orjson.dumps(obj, default=str).decode()
+
+
+class ToolExecutionError(Exception):
+    """Ошибка выполнения инструмента.
+
+    Несёт сериализованный результат с ошибкой; поднимается вместо возврата,
+    чтобы st.cache_data не сохранил неудачный вызов.
+    """
+
+    def __init__(self, payload: str):
+        super().__init__(payload)
+        self.payload = payload
+
+
+def _run_tool(tool_name: str, tool_input: dict) -> str:
+    """Выполняет инструмент и возвращает результат.
+
+    Любая ошибка (исключение или "error" в результате инструмента)
+    поднимается как ToolExecutionError и не попадает в кэш.
+    """
+    if tool_name == "search_chat_history":
+        result = search_chat_history(**tool_input)
+    elif tool_name == "search_agent_memory":
+        result = search_agent_memory(**tool_input)
+    elif tool_name == "save_to_memory":
+        result = save_to_memory(**tool_input)
+    elif tool_name == "web_search":
+        result = web_search(**tool_input)
+    elif tool_name == "search_purchases":
+        result = search_purchases(**tool_input)
+    elif tool_name == "search_purchases_batch":
+        result = search_purchases_batch(**tool_input)
+    elif tool_name == "search_sales":
+        result = search_sales(**tool_input)
+    elif tool_name == "search_nomenclature":
+        result = search_nomenclature(**tool_input)
+    elif tool_name == "search_clients":
+        result = search_clients(**tool_input)
+    elif tool_name == "get_price_dynamics":
+        result = get_price_dynamics(**tool_input)
+    elif tool_name == "get_top_clients":
+        result = get_top_clients(**tool_input)
+    elif tool_name == "get_top_products":
+        result = get_top_products(**tool_input)
+    elif tool_name == "get_summary_stats":
+        result = get_summary_stats()
+    else:
+        result = {"error": f"Неизвестный инструмент: {tool_name}"}
+
+    if isinstance(result, dict) and result.get("error"):
+        raise ToolExecutionError(_dumps(result))
+
+    return _dumps(result)
+
+
+# Инструменты, которые нельзя кэшировать: запись в память и поиск по данным,
+# которые пополняются прямо по ходу сессии (save_to_memory пишет в
+# agent_memory, история чата растёт с каждым сообщением)
+_UNCACHED_TOOLS = {"save_to_memory", "search_chat_history", "search_agent_memory"}
+
+# Инструменты, чьи результаты не запоминаются в memo сессии: вдобавок к
+# некэшируемым это web_search — новости и рыночные цены устаревают в течение
+# сессии, а короткую дедупликацию ему и так даёт st.cache_data с TTL
+_MEMO_EXCLUDED_TOOLS = _UNCACHED_TOOLS | {"web_search"}
+
+
+@st.cache_data(ttl=300, show_spinner=False)
+def _cached_tool(tool_name: str, args_json: str) -> str:
+    return _run_tool(tool_name, json.loads(args_json))
+
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def _cached_tool_hourly(tool_name: str, args_json: str) -> str:
+    return _run_tool(tool_name, json.loads(args_json))
+
+
+# История закупочных цен меняется редко — её можно держать в кэше дольше
+_LONG_TTL_TOOLS = {"get_price_dynamics"}
+
+
+def execute_tool(tool_name: str, tool_input: dict) -> tuple[str, bool]:
+    """Выполняет инструмент, отдавая повторные вызовы из кэша.
+
+    Возвращает (payload, успех). Ошибки перехватываются здесь, за пределами
+    st.cache_data: неудачный вызов возвращает LLM payload с "error", но не
+    оседает ни в кэше, ни (по флагу успеха) в memo сессии.
+    """
     try:
-        if tool_name == "search_chat_history":
-            result = search_chat_history(**tool_input)
-        elif tool_name == "search_agent_memory":
-            result = search_agent_memory(**tool_input)
-        elif tool_name == "save_to_memory":
-            result = save_to_memory(**tool_input)
-        elif tool_name == "web_search":
-            result = web_search(**tool_input)
-        elif tool_name == "search_purchases":
-            result = search_purchases(**tool_input)
-        elif tool_name == "search_sales":
-            result = search_sales(**tool_input)
-        elif tool_name == "search_nomenclature":
-            result = search_nomenclature(**tool_input)
-        elif tool_name == "search_clients":
-            result = search_clients(**tool_input)
-        elif tool_name == "get_price_dynamics":
-            result = get_price_dynamics(**tool_input)
-        elif tool_name == "get_top_clients":
-            result = get_top_clients(**tool_input)
-        elif tool_name == "get_top_products":
-            result = get_top_products(**tool_input)
-        elif tool_name == "get_summary_stats":
-            result = get_summary_stats()
-        else:
-            result = {"error": f"Неизвестный инструмент: {tool_name}"}
-        
-        return json.dumps(result, ensure_ascii=False, default=str)
+        if tool_name in _UNCACHED_TOOLS:
+            return _run_tool(tool_name, tool_input), True
+
+        args_json = json.dumps(tool_input, sort_keys=True, ensure_ascii=False)
+        if tool_name in _LONG_TTL_TOOLS:
+            return _cached_tool_hourly(tool_name, args_json), True
+        return _cached_tool(tool_name, args_json), True
+    except ToolExecutionError as e:
+        return e.payload, False
     except Exception as e:
-        return json.dumps({"error": str(e)}, ensure_ascii=False)
+        return _dumps({"error": str(e)}), False
 
 
 # ============================================================
@@ -885,43 +1084,70 @@ SYSTEM_PROMPT = """Ты — интеллектуальный помощник к
 1. Используй инструменты для поиска данных перед ответом
 2. Если пользователь ссылается на прошлые разговоры — ищи в search_chat_history
 3. Если узнаёшь важный факт о компании — сохрани через save_to_memory
-4. Для внутренних данных — используй search_purchases, search_sales и др.
+4. Для внутренних данных — используй search_purchases, search_sales и др.;
+   если позиций несколько — search_purchases_batch одним вызовом вместо серии
 5. Для внешней информации — используй web_search
 6. Отвечай на русском языке
 7. Форматируй числа с разделителями тысяч (1 234 567)
 8. Суммы указывай в рублях
 9. Если данных нет — так и скажи, не выдумывай
 10. Будь кратким, но информативным
+11. Табличные данные инструментов приходят в колоночном виде:
+    "columns" — имена колонок, "rows" — строки со значениями в том же порядке
 
 Текущая дата: {current_date}
 """
 
 
-def get_ai_response(user_message: str, chat_history: list) -> tuple[str, list]:
-    """Получает ответ от Claude с использованием инструментов"""
-    
+def get_ai_response(user_message: str, chat_history: list,
+                    on_text=None, tool_memo: dict = None) -> tuple[str, list]:
+    """Получает ответ от Claude с использованием инструментов.
+
+    on_text — колбэк для потокового вывода: вызывается с накопленным
+    текстом по мере генерации ответа.
+    tool_memo — memo результатов инструментов на время сессии: повторные
+    вызовы из прошлых ходов не идут в БД, а свежие превью подмешиваются
+    в системный промпт, чтобы модель не запрашивала их заново.
+    """
+
     client = anthropic.Anthropic(api_key=st.secrets["anthropic"]["api_key"])
-    
+
     # Формируем сообщения
     messages = []
     for msg in chat_history:
         messages.append({"role": msg["role"], "content": msg["content"]})
     messages.append({"role": "user", "content": user_message})
-    
+
     system = SYSTEM_PROMPT.format(current_date=datetime.now().strftime("%Y-%m-%d"))
-    
+
+    if tool_memo:
+        previews = "\n".join(
+            f"- {key} -> {result[:200]}"
+            for key, result in list(tool_memo.items())[-5:]
+        )
+        system += ("\n\nУже полученные в этой сессии результаты инструментов "
+                   "(не запрашивай их повторно без необходимости):\n" + previews)
+
     tools_used = []
-    
+    streamed_text = ""
+
     # Цикл обработки с инструментами
     while True:
-        response = client.messages.create(
+        # Стримим ответ: текст показывается по мере генерации,
+        # а не после завершения всего хода ассистента
+        with client.messages.stream(
             model="claude-sonnet-4-20250514",
             max_tokens=4096,
             system=system,
             tools=TOOLS,
             messages=messages
-        )
-        
+        ) as stream:
+            for chunk in stream.text_stream:
+                streamed_text += chunk
+                if on_text:
+                    on_text(streamed_text)
+            response = stream.get_final_message()
+
         # Проверяем нужно ли вызвать инструменты
         if response.stop_reason == "tool_use":
             # Собираем все вызовы инструментов
@@ -930,21 +1156,58 @@ def get_ai_response(user_message: str, chat_history: list) -> tuple[str, list]:
             # Добавляем ответ ассистента в историю
             messages.append({"role": "assistant", "content": response.content})
             
-            # Выполняем инструменты и добавляем результаты
-            tool_results = []
+            # Одинаковые вызовы выполняем один раз, разные — параллельно
+            unique = {}
             for tool_call in tool_calls:
-                tool_result = execute_tool(tool_call.name, tool_call.input)
+                key = (tool_call.name, json.dumps(tool_call.input, sort_keys=True))
+                unique.setdefault(key, []).append(tool_call)
+
+            # Результаты из прошлых ходов сессии берём из memo без похода в БД
+            results = {}
+            pending = {}
+            for key, calls in unique.items():
+                memo_key = f"{key[0]}:{key[1]}"
+                if tool_memo is not None and memo_key in tool_memo:
+                    results[key] = tool_memo[memo_key]
+                else:
+                    pending[key] = calls
+
+            if len(pending) > 1:
+                with ThreadPoolExecutor(max_workers=len(pending)) as executor:
+                    futures = {
+                        key: executor.submit(execute_tool, key[0], calls[0].input)
+                        for key, calls in pending.items()
+                    }
+                    outcomes = {key: f.result() for key, f in futures.items()}
+            else:
+                outcomes = {
+                    key: execute_tool(key[0], calls[0].input)
+                    for key, calls in pending.items()
+                }
+
+            for key, (payload, ok) in outcomes.items():
+                results[key] = payload
+                # Неудачные вызовы в memo не попадают — иначе одна
+                # транзиентная ошибка воспроизводилась бы до конца сессии
+                if ok and tool_memo is not None and key[0] not in _MEMO_EXCLUDED_TOOLS:
+                    tool_memo[f"{key[0]}:{key[1]}"] = payload
+
+            # Раскладываем результаты обратно по всем tool_use_id
+            tool_results = []
+            for key, calls in unique.items():
+                tool_result = results[key]
                 tools_used.append({
-                    "name": tool_call.name,
-                    "input": tool_call.input,
+                    "name": key[0],
+                    "input": calls[0].input,
                     "output_preview": tool_result[:500] + "..." if len(tool_result) > 500 else tool_result
                 })
-                tool_results.append({
-                    "type": "tool_result",
-                    "tool_use_id": tool_call.id,
-                    "content": tool_result
-                })
-            
+                for tool_call in calls:
+                    tool_results.append({
+                        "type": "tool_result",
+                        "tool_use_id": tool_call.id,
+                        "content": tool_result
+                    })
+
             messages.append({"role": "user", "content": tool_results})
         else:
             # Финальный ответ
@@ -972,7 +1235,7 @@ def main():
     
     # Проверка подключения к БД
     try:
-        get_db_connection()
+        get_db_pool()
     except Exception as e:
         st.error(f"❌ Ошибка подключения к БД: {e}")
         return
@@ -990,6 +1253,9 @@ def main():
     
     if "tools_log" not in st.session_state:
         st.session_state.tools_log = []
+
+    if "tool_memo" not in st.session_state:
+        st.session_state.tool_memo = {}
     
     # Боковая панель
     with st.sidebar:
@@ -1027,6 +1293,7 @@ def main():
         if st.button("🗑️ Очистить историю", use_container_width=True):
             st.session_state.messages = []
             st.session_state.tools_log = []
+            st.session_state.tool_memo = {}
             st.rerun()
         
         # Лог инструментов
@@ -1061,14 +1328,17 @@ def main():
         
         # Получаем ответ
         with st.chat_message("assistant"):
+            placeholder = st.empty()
             with st.spinner("Думаю..."):
                 try:
                     response, tools_used = get_ai_response(
-                        user_input, 
-                        st.session_state.messages[:-1]  # без последнего сообщения
+                        user_input,
+                        st.session_state.messages[:-1],  # без последнего сообщения
+                        on_text=placeholder.markdown,
+                        tool_memo=st.session_state.tool_memo
                     )
-                    st.markdown(response)
-                    
+                    placeholder.markdown(response)
+
                     # Сохраняем
                     st.session_state.messages.append({"role": "assistant", "content": response})
                     st.session_state.tools_log.extend(tools_used)